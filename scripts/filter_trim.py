@@ -11,10 +11,10 @@ Input:
 Outputs:
 - filtered fastq file (transpson sequence is clipped)
 - list of unique molecular identifiers
-- list of indices of reads that pass the filter 
+- list of indices of reads that pass the filter (NumPy .npy file)
 
 Usage:
-    python fastq_filter.py -i input.fastq -o output_directory [--trim_length N]
+    python fastq_filter.py -i input.fastq -o output_directory [--trim_length N] [--threads N]
 
 Example:
     python fastq_filter.py -i sample.fastq -o filtered_results --trim_length 50
@@ -22,12 +22,50 @@ Example:
 
 import time
 import os
+import sys
 import argparse
 import logging
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
+import mmap
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
 import numpy as np
 import regex as re  # Using the 'regex' module for fuzzy matching
 
+try:
+    import hyperscan
+
+    HAVE_HYPERSCAN = True
+except ImportError:
+    HAVE_HYPERSCAN = False
+
+try:
+    from numba import njit
+
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
+# Output is accumulated in memory and flushed to disk in blocks of this size
+WRITE_BUFFER_SIZE = 1 << 20
+# Number of reads handed to the transposon matcher at once
+MATCH_BATCH_SIZE = 4096
+# Size of the input sections processed independently (and in parallel)
+PARALLEL_CHUNK_SIZE = 64 << 20
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
@@ -67,6 +105,12 @@ def parse_arguments():
         default=1,
         help="Maximum number of allowed errors in the transposon sequence (default: 1).",
     )
+    parser.add_argument(
+        "--threads",
+        type=positive_int,
+        default=os.cpu_count(),
+        help="Number of worker processes (default: number of CPUs).",
+    )
     parser.add_argument(
         "--version",
         action="version",
@@ -92,8 +136,357 @@ def ensure_output_directory(path):
         logging.info(f"Output directory already exists: {path}")
 
 
+def map_fastq(path):
+    """
+    Memory-maps a FastQ file for reading, hinting to the OS that it will be read
+    sequentially. Returns an empty bytes object for an empty file.
+    """
+    if os.path.getsize(path) == 0:
+        return b""
+    with open(path, "rb") as handle:
+        mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapped, "madvise"):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return mapped
+
+
+def read_fastq_records(data, start=0, end=None):
+    """
+    Yields (title, seq, qual) memoryviews for the FastQ records in data[start:end],
+    where data is a bytes-like object such as a memory-mapped file.
+    Records are sliced out of data in place, so no per-line bytes or str objects
+    are created.
+    """
+    if end is None:
+        end = len(data)
+    view = memoryview(data)
+    find = data.find
+
+    while start < end:
+        if data[start] == 10:  # Skip blank lines
+            start += 1
+            continue
+        title_end = find(b"\n", start, end)
+        seq_end = find(b"\n", title_end + 1, end)
+        plus_end = find(b"\n", seq_end + 1, end)
+        if not start < title_end < seq_end < plus_end:
+            raise ValueError("Truncated FastQ record at end of file.")
+        if data[start] != 64 or data[seq_end + 1] != 43:  # b"@", b"+"
+            raise ValueError(f"Malformed FastQ record: {bytes(view[start:title_end])}")
+        qual_end = find(b"\n", plus_end + 1, end)
+        if qual_end == -1:
+            if plus_end + 1 == end:
+                raise ValueError("Truncated FastQ record at end of file.")
+            qual_end = end  # Final record without a trailing newline
+
+        # Drop the carriage returns of CRLF line endings
+        title_stop = title_end - (data[title_end - 1] == 13)
+        seq_stop = seq_end - (data[seq_end - 1] == 13)
+        qual_stop = qual_end - (data[qual_end - 1] == 13)
+        if seq_stop - title_end != qual_stop - plus_end:
+            raise ValueError(
+                "Lengths of sequence and quality values differs for "
+                f"{bytes(view[start + 1 : title_stop])}"
+            )
+        yield (
+            view[start + 1 : title_stop],
+            view[title_end + 1 : seq_stop],
+            view[plus_end + 1 : qual_stop],
+        )
+        start = qual_end + 1
+
+
+@njit(cache=True, nogil=True)
+def _transposon_end_bitap(seq, masks, pattern_length, max_errors):
+    """
+    Bitap (Wu-Manber) search for a pattern of at most 64 bp allowing up to
+    max_errors substitutions, insertions or deletions.
+    seq is a uint8 array and masks[c] has bit i set where pattern[i] == c.
+    Returns the end position of the lowest-distance match (preferring the longer
+    match on ties), or -1 if the pattern is not found.
+    """
+    one = np.uint64(1)
+    accept = one << np.uint64(pattern_length - 1)
+    # Bit i of state[j] is set if pattern[:i + 1] ends here with <= j errors
+    state = np.empty(max_errors + 1, dtype=np.uint64)
+    for j in range(max_errors + 1):
+        state[j] = (one << np.uint64(j)) - one
+
+    best_end = -1
+    best_dist = max_errors + 1
+    stop = len(seq)
+    for i in range(len(seq)):
+        mask = masks[seq[i]]
+        prev_old = state[0]
+        state[0] = ((prev_old << one) | one) & mask
+        for j in range(1, max_errors + 1):
+            old = state[j]
+            state[j] = (
+                (((old << one) | one) & mask)  # match
+                | (prev_old << one)  # substitution
+                | prev_old  # insertion in the read
+                | (state[j - 1] << one)  # deletion from the read
+                | one
+            )
+            prev_old = old
+
+        for j in range(min(best_dist + 1, max_errors + 1)):
+            if state[j] & accept:
+                if best_end == -1:
+                    # Overlapping matches end within 2 * max_errors of the first
+                    stop = min(stop, i + 1 + 2 * max_errors)
+                best_dist = j
+                best_end = i + 1
+                break
+        if best_dist == 0 or i + 1 >= stop:
+            break
+
+    return best_end
+
+
+def _transposon_end_bitap_py(seq, masks, pattern_length, max_errors):
+    """
+    Pure-Python version of _transposon_end_bitap on Python integers, which supports
+    patterns of any length. seq is a bytes-like object and masks a list of ints.
+    """
+    accept = 1 << (pattern_length - 1)
+    state = [(1 << j) - 1 for j in range(max_errors + 1)]
+
+    best_end = -1
+    best_dist = max_errors + 1
+    stop = len(seq)
+    for i, base in enumerate(seq):
+        mask = masks[base]
+        prev_old = state[0]
+        state[0] = ((prev_old << 1) | 1) & mask
+        for j in range(1, max_errors + 1):
+            old = state[j]
+            state[j] = (
+                (((old << 1) | 1) & mask)
+                | (prev_old << 1)
+                | prev_old
+                | (state[j - 1] << 1)
+                | 1
+            )
+            prev_old = old
+
+        for j in range(min(best_dist + 1, max_errors + 1)):
+            if state[j] & accept:
+                if best_end == -1:
+                    stop = min(stop, i + 1 + 2 * max_errors)
+                best_dist = j
+                best_end = i + 1
+                break
+        if best_dist == 0 or i + 1 >= stop:
+            break
+
+    return best_end
+
+
+def _bitap_masks(transposon_seq):
+    """
+    Returns the Bitap character masks of the transposon as a list of 256 ints,
+    where masks[c] has bit i set if c matches transposon_seq[i] (ignoring case).
+    """
+    masks = [0] * 256
+    for i, base in enumerate(transposon_seq.upper().encode()):
+        masks[base] |= 1 << i
+        masks[ord(chr(base).lower())] |= 1 << i
+    return masks
+
+
+def _compile_hyperscan_matcher(transposon_seq, max_errors):
+    """
+    Builds a Hyperscan database with one copy of the transposon per allowed edit
+    distance (the expression id is the distance), and returns a function that
+    scans a batch of reads in a single call.
+    Follows the same rules as the Bitap kernel: lowest distance wins among matches
+    ending within 2 * max_errors of the first, ties go to the longer match.
+    """
+    expression = "".join(f"\\x{base:02x}" for base in transposon_seq.encode())
+    distances = list(range(max_errors + 1))
+    database = hyperscan.Database()
+    database.compile(
+        expressions=[expression.encode()] * len(distances),
+        ids=distances,
+        elements=len(distances),
+        flags=hyperscan.HS_FLAG_CASELESS,
+        ext=[
+            (hyperscan.HS_EXT_FLAG_EDIT_DISTANCE if d else 0, 0, 0, 0, d, 0)
+            for d in distances
+        ],
+    )
+    # A match spanning a separator of max_errors + 1 bytes would exceed max_errors
+    separator = b"\n" * (max_errors + 1)
+    window = 2 * max_errors
+
+    def find_ends(seqs):
+        read_starts = []
+        read_ends = []
+        offset = 0
+        for seq in seqs:
+            read_starts.append(offset)
+            offset += len(seq)
+            read_ends.append(offset)
+            offset += len(separator)
+
+        ends = [-1] * len(seqs)
+        first_ends = [-1] * len(seqs)
+        best_dists = [max_errors + 1] * len(seqs)
+
+        def on_match(distance, _start, end, _flags, _context):
+            # Hyperscan reports matches in order of increasing end offset
+            i = bisect_left(read_ends, end)
+            if end <= read_starts[i]:
+                return  # Match ends inside a separator
+            if first_ends[i] == -1:
+                first_ends[i] = end
+            elif end > first_ends[i] + window:
+                return
+            if distance <= best_dists[i]:
+                best_dists[i] = distance
+                ends[i] = end - read_starts[i]
+
+        database.scan(separator.join(seqs), match_event_handler=on_match)
+        return ends
+
+    return find_ends
+
+
+@lru_cache(maxsize=None)
+def compile_transposon_matcher(transposon_seq, max_errors):
+    """
+    Returns a function that maps a batch (list) of read sequences (bytes) to the end
+    positions of the transposon matches, with -1 where the transposon is not found.
+    Uses Hyperscan when available, then a compiled Bitap kernel when numba is
+    available, and otherwise falls back to the 'regex' module.
+    """
+    if HAVE_HYPERSCAN:
+        return _compile_hyperscan_matcher(transposon_seq, max_errors)
+
+    pattern_length = len(transposon_seq)
+    if HAVE_NUMBA and pattern_length <= 64:
+        masks = np.array(_bitap_masks(transposon_seq), dtype=np.uint64)
+
+        def find_end(seq):
+            return _transposon_end_bitap(
+                np.frombuffer(seq, dtype=np.uint8), masks, pattern_length, max_errors
+            )
+
+    else:
+        pattern = re.compile(
+            f"({transposon_seq}){{e<={max_errors}}}".encode(), re.IGNORECASE
+        )
+        masks = _bitap_masks(transposon_seq)
+        window = 2 * max_errors
+
+        def find_end(seq):
+            # regex returns the first match rather than the best one, so the read up
+            # to just past it is rescanned with Bitap to pick the same match as the
+            # other backends
+            match = pattern.search(seq)
+            if match is None:
+                return -1
+            return _transposon_end_bitap_py(
+                seq[: match.end() + window], masks, pattern_length, max_errors
+            )
+
+    def find_ends(seqs):
+        return [find_end(seq) for seq in seqs]
+
+    return find_ends
+
+
+def find_chunk_boundaries(data, chunk_size):
+    """
+    Splits a FastQ buffer into byte ranges of roughly chunk_size bytes, with each
+    boundary moved forward to the start of the next record.
+    Returns a list of (start, end) tuples covering the whole buffer.
+    """
+    boundaries = [0]
+    offset = chunk_size
+    while offset < len(data):
+        # A line starting with '@' can also be a quality line, but only a title line
+        # is followed two lines later by the '+' separator
+        line_start = data.find(b"\n@", offset - 1) + 1
+        while line_start > 0:
+            seq_end = data.find(b"\n", data.find(b"\n", line_start) + 1)
+            if data[seq_end + 1 : seq_end + 2] == b"+":
+                break
+            line_start = data.find(b"\n@", line_start) + 1
+        if line_start == 0:
+            break
+        boundaries.append(line_start)
+        offset = line_start + chunk_size
+    boundaries.append(len(data))
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def filter_fastq_chunk(
+    input_fastq, start, end, transposon_seq, max_errors, trim_length, umi_length
+):
+    """
+    Filters and trims the FastQ records in the byte range [start, end) of the input.
+    Returns the filtered FastQ records and UMIs as bytes, the indices of passing
+    reads relative to the start of the range, and the number of reads in the range.
+    """
+    # The matcher is cached, so each worker process only builds it once
+    find_transposon_ends = compile_transposon_matcher(transposon_seq, max_errors)
+
+    # Without a trim length the entire sequence after the trim position is retained,
+    # slicing past the end of a read simply stops at its last base
+    retain_length = trim_length if trim_length is not None else sys.maxsize
+
+    # Indices of passing reads, grown geometrically as needed
+    passed_indices = np.empty(1 << 16, dtype=np.int64)
+    n_passed = 0
+    counter = 0  # Read counter within the range
+
+    out_buf = bytearray()
+    umi_buf = bytearray()
+
+    records = read_fastq_records(map_fastq(input_fastq), start, end)
+    for batch in iter(lambda: list(islice(records, MATCH_BATCH_SIZE)), []):
+        match_ends = find_transposon_ends([seq for _, seq, _ in batch])
+        for (title, seq, qual), match_end in zip(batch, match_ends):
+            counter += 1
+            if match_end != -1:
+                if n_passed == passed_indices.size:
+                    passed_indices.resize(2 * passed_indices.size, refcheck=False)
+                passed_indices[n_passed] = counter - 1  # Zero-based indexing
+                n_passed += 1
+
+                # Determine the trim position
+                trim_position = match_end - 2  # Retain 'TA' from original script
+
+                end_position = trim_position + retain_length
+                trimmed_seq = seq[trim_position:end_position]
+                trimmed_qual = qual[trim_position:end_position]
+
+                # Buffer the trimmed or original read for the output FastQ
+                out_buf += b"@"
+                out_buf += title
+                out_buf += b"\n"
+                out_buf += trimmed_seq
+                out_buf += b"\n+\n"
+                out_buf += trimmed_qual
+                out_buf += b"\n"
+
+                # Extract and buffer the UMI
+                umi_buf += seq[:umi_length]
+                umi_buf += b"\n"
+
+    return out_buf, umi_buf, passed_indices[:n_passed], counter
+
+
 def filter_and_process_fastq(
-    input_fastq, output_dir, transposon_seq, max_errors, trim_length, umi_length
+    input_fastq,
+    output_dir,
+    transposon_seq,
+    max_errors,
+    trim_length,
+    umi_length,
+    threads=1,
 ):
     start_time = time.time()
 
@@ -102,57 +495,57 @@ def filter_and_process_fastq(
     trimmed_fastq = os.path.join(output_dir, f"filtered_{base_filename}")
     umi_file = os.path.join(output_dir, f"UMI_{os.path.splitext(base_filename)[0]}.txt")
     index_file = os.path.join(
-        output_dir, f"PF_{os.path.splitext(base_filename)[0]}.index"
+        output_dir, f"PF_{os.path.splitext(base_filename)[0]}.index.npy"
     )
 
-    # Compile the regex pattern once for efficiency
-    pattern = re.compile(f"({transposon_seq}){{e<={max_errors}}}", re.IGNORECASE)
-
-    passed_indices = []
-    counter = 0  # Overall read counter
-
     logging.info(f"Processing FastQ file: {input_fastq}")
 
-    with open(input_fastq, "r") as in_handle, open(
-        trimmed_fastq, "w"
-    ) as out_handle, open(umi_file, "w") as umi_handle:
-
-        for title, seq, qual in FastqGeneralIterator(in_handle):
-            counter += 1
-            match = pattern.search(seq)
-            if match:
-                passed_indices.append(counter - 1)  # Zero-based indexing
+    chunks = find_chunk_boundaries(map_fastq(input_fastq), PARALLEL_CHUNK_SIZE)
+    chunk_args = (transposon_seq, max_errors, trim_length, umi_length)
 
-                # Determine the trim position
-                trim_position = match.span()[1] - 2  # Retain 'TA' from original script
-
-                if trim_length is not None:
-                    # Calculate the end position ensuring it doesn't exceed the sequence length
-                    end_position = trim_position + trim_length
-                    trimmed_seq = seq[trim_position:end_position]
-                    trimmed_qual = qual[trim_position:end_position]
-                else:
-                    # Retain the entire sequence after the trim position
-                    trimmed_seq = seq[trim_position:]
-                    trimmed_qual = qual[trim_position:]
+    passed_indices = []
+    n_passed = 0
+    counter = 0  # Overall read counter
 
-                # Write the trimmed or original read to the output FastQ
-                out_handle.write(f"@{title}\n{trimmed_seq}\n+\n{trimmed_qual}\n")
+    with open(trimmed_fastq, "wb", buffering=WRITE_BUFFER_SIZE) as out_handle, open(
+        umi_file, "wb", buffering=WRITE_BUFFER_SIZE
+    ) as umi_handle:
 
-                # Extract and write the UMI
-                umi = seq[:umi_length]
-                umi_handle.write(f"{umi}\n")
+        def write_chunk(result):
+            nonlocal n_passed, counter
+            fastq_bytes, umi_bytes, chunk_indices, n_reads = result
+            out_handle.write(fastq_bytes)
+            umi_handle.write(umi_bytes)
+            passed_indices.append(chunk_indices + counter)
+            n_passed += len(chunk_indices)
+            counter += n_reads
+            logging.info(f"Processed {counter} reads...")
 
-            if counter % 1_000_000 == 0:
-                logging.info(f"Processed {counter} reads...")
+        if threads == 1:
+            for start, end in chunks:
+                write_chunk(filter_fastq_chunk(input_fastq, start, end, *chunk_args))
+        else:
+            # Chunks are written in file order, with a bounded number in flight
+            with ProcessPoolExecutor(max_workers=threads) as executor:
+                pending = deque()
+                for start, end in chunks:
+                    pending.append(
+                        executor.submit(
+                            filter_fastq_chunk, input_fastq, start, end, *chunk_args
+                        )
+                    )
+                    if len(pending) >= 2 * threads:
+                        write_chunk(pending.popleft().result())
+                while pending:
+                    write_chunk(pending.popleft().result())
 
-    # Save the indices of passing reads
-    np.savetxt(index_file, passed_indices, fmt="%d")
+    # Save the indices of passing reads in binary NumPy format
+    np.save(index_file, np.concatenate(passed_indices or [np.empty(0, np.int64)]))
 
     elapsed_time = time.time() - start_time
     logging.info(f"Filtering completed in {elapsed_time:.2f} seconds.")
     logging.info(f"Total reads processed: {counter}")
-    logging.info(f"Total reads passed: {len(passed_indices)}")
+    logging.info(f"Total reads passed: {n_passed}")
     logging.info(f"Trimmed FastQ saved to: {trimmed_fastq}")
     logging.info(f"UMIs saved to: {umi_file}")
     logging.info(f"Indices saved to: {index_file}")
@@ -169,6 +562,7 @@ def main():
         max_errors=args.max_errors,
         trim_length=args.trim_length,
         umi_length=args.umi_length,
+        threads=args.threads,
     )
 
 
@@ -10,7 +10,7 @@ Usage:
         --sam_r1 /path/to/read1.sam \
         --sam_r2 /path/to/read2.sam \
         --umi_list /path/to/UMI_sample.txt \
-        --indices_pf /path/to/PF_sample.index \
+        --indices_pf /path/to/PF_sample.index.npy \
         --output_dir /path/to/output_directory
 """
 
@@ -20,7 +20,22 @@ import argparse
 import pysam
 import numpy as np
 import logging
-import re
+from itertools import chain
+
+try:
+    from numba import get_num_threads, njit, prange
+
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
+# Base-5 digit of each UMI base, all other characters (e.g. N) are encoded as 4
+UMI_BASE_CODES = np.full(256, 4, dtype=np.uint64)
+UMI_BASE_CODES[np.frombuffer(b"ACGTacgt", dtype=np.uint8)] = [0, 1, 2, 3, 0, 1, 2, 3]
 
 
 def parse_arguments():
@@ -35,7 +50,7 @@ def parse_arguments():
     parser.add_argument("--sam_r2", required=True, help="Path to the Read2 SAM file.")
     parser.add_argument("--umi_list", required=True, help="Path to the UMI list file.")
     parser.add_argument(
-        "--indices_pf", required=True, help="Path to the PF index file."
+        "--indices_pf", required=True, help="Path to the PF index (.npy) file."
     )
     parser.add_argument(
         "--output_dir", required=True, help="Directory to store the output file."
@@ -56,47 +71,107 @@ def setup_logging(output_dir):
     logging.info("Logging initialized.")
 
 
-def get_positions(sam_file_path):
+def get_alignment_position(read):
+    """
+    Returns the mapping position of an alignment: the alignment start for forward
+    reads and the last aligned base for reverse reads, read directly from the
+    alignment without expanding the CIGAR.
+    Returns -1 for unmapped or multi-mapped reads.
     """
-    Extracts mapping positions from the SAM file.
-    Returns a NumPy array of positions.
+    flag = read.flag
+    # Check if the read is mapped and uniquely aligned
+    if flag & 4 or read.has_tag("XS"):
+        return -1  # Unmapped or multiple mappings
+    # reference_end is exclusive, and None if the alignment has no CIGAR
+    reference_end = read.reference_end
+    if reference_end is None:
+        return -1  # No aligned bases
+    if flag & 16:
+        return reference_end - 1  # Reverse strand
+    return read.reference_start  # Forward strand
+
+
+def get_paired_positions(sam_r1_path, sam_r2_path, indices_pf):
     """
-    positions = []
+    Extracts mapping positions from the Read1 and Read2 SAM files in a single pass.
+    The Read1 SAM file only contains reads which passed the filter, so each Read1
+    alignment is paired with the Read2 alignment at the next PF index, and all other
+    Read2 alignments are skipped.
+    Returns NumPy arrays of Read1 and Read2 positions for the reads passing the filter.
+    """
+    n_pf = len(indices_pf)
+    positions_r1 = np.empty(n_pf, dtype=np.int64)
+    positions_r2 = np.empty(n_pf, dtype=np.int64)
+    # Convert the PF indices to Python ints a block at a time
+    block = 1 << 16
+    pf_indices = chain.from_iterable(
+        indices_pf[i : i + block].tolist() for i in range(0, n_pf, block)
+    )
+
+    n_paired = 0
     try:
-        with pysam.AlignmentFile(sam_file_path, "r") as sam_file:
-            for read in sam_file:
-                pos = read.get_reference_positions(full_length=False)
-                # Check if the read is mapped and uniquely aligned
-                if pos and not read.has_tag("XS"):
-                    # Determine strand
-                    if read.is_forward:
-                        positions.append(pos[0])
-                    elif read.is_reverse:
-                        positions.append(pos[-1])
-                    else:
-                        positions.append(-1)  # Undefined strand
+        with pysam.AlignmentFile(sam_r1_path, "r") as sam_r1, pysam.AlignmentFile(
+            sam_r2_path, "r"
+        ) as sam_r2:
+            reads_r1 = iter(sam_r1)
+            reads_r2 = enumerate(sam_r2)
+            for pf_index, read_r1 in zip(pf_indices, reads_r1):
+                for i, read_r2 in reads_r2:
+                    if i == pf_index:
+                        break
                 else:
-                    positions.append(-1)  # Unmapped or multiple mappings
+                    break  # Read2 file ended before the PF index
+                positions_r1[n_paired] = get_alignment_position(read_r1)
+                positions_r2[n_paired] = get_alignment_position(read_r2)
+                n_paired += 1
+            extra_r1 = next(reads_r1, None) is not None
     except Exception as e:
-        logging.error(f"Error processing SAM file {sam_file_path}: {e}")
+        logging.error(f"Error processing SAM files {sam_r1_path}, {sam_r2_path}: {e}")
         sys.exit(1)
 
-    positions = np.array(positions)
-    logging.info(f"Extracted positions from SAM file: {sam_file_path}")
-    return positions
+    # Every read which passed the filter should have exactly one alignment in each file
+    if n_paired != n_pf or extra_r1:
+        logging.error(
+            "Number of reads in read 1 and read 2 data is not equal after filtering."
+        )
+        sys.exit(1)
+
+    logging.info(f"Extracted positions from SAM files: {sam_r1_path}, {sam_r2_path}")
+    return positions_r1, positions_r2
 
 
 def load_umi_list(umi_file):
     """
-    Loads UMI list from a text file.
-    Returns a list of UMIs.
+    Loads UMI list from a text file with one fixed-length UMI per line.
+    The file is memory-mapped rather than parsed.
+    Returns a NumPy array of fixed-width bytes UMIs.
     """
     if not os.path.isfile(umi_file):
         logging.error(f"UMI file does not exist: {umi_file}")
         sys.exit(1)
     try:
-        with open(umi_file, "r") as f:
-            umi_list = f.read().splitlines()
+        with open(umi_file, "rb") as f:
+            line_length = len(f.readline())
+        if line_length == 0:
+            umi_list = np.empty(0, dtype="S1")
+        else:
+            raw = np.memmap(umi_file, dtype=np.uint8, mode="r")
+            # Every record must end in a newline at the same offset, otherwise the
+            # fixed-width view below would be misaligned
+            if len(raw) % line_length != 0 or not np.all(
+                raw[line_length - 1 :: line_length] == ord("\n")
+            ):
+                raise ValueError("UMIs are not all of the same length.")
+            # Each record is a UMI followed by a newline, which is left out of the view
+            record = np.dtype(
+                {
+                    "names": ["umi"],
+                    "formats": [f"S{line_length - 1}"],
+                    "offsets": [0],
+                    "itemsize": line_length,
+                }
+            )
+            umi_list = raw.view(record)["umi"]
         logging.info(f"Loaded {len(umi_list)} UMIs from {umi_file}")
         return umi_list
     except Exception as e:
@@ -113,7 +188,7 @@ def load_indices_pf(indices_file):
         logging.error(f"Indices PF file does not exist: {indices_file}")
         sys.exit(1)
     try:
-        indices = np.loadtxt(indices_file, dtype=int)
+        indices = np.load(indices_file)
         logging.info(f"Loaded {len(indices)} PF indices from {indices_file}")
         return indices
     except Exception as e:
@@ -121,21 +196,79 @@ def load_indices_pf(indices_file):
         sys.exit(1)
 
 
+def encode_umis(umi_list):
+    """
+    Encodes fixed-length UMIs as integers, reading each base as a base-5 digit
+    (A, C, G, T, and 4 for N or any other character).
+    Returns a NumPy array of uint64 UMI codes and the number of possible codes.
+    """
+    umi_arr = np.ascontiguousarray(umi_list, dtype="S")
+    umi_length = umi_arr.dtype.itemsize
+    bases = umi_arr.view(np.uint8).reshape(len(umi_arr), umi_length)
+    digits = UMI_BASE_CODES[bases]
+    umi_codes = np.zeros(len(umi_arr), dtype=np.uint64)
+    for i in range(umi_length):
+        umi_codes = umi_codes * np.uint64(5) + digits[:, i]
+    return umi_codes, 5**umi_length
+
+
 def process_umi_positions(umi_list, positions_r2_pf):
     """
     Combines UMI with Read2 mapping positions to create unique identifiers.
-    Returns a list of combined UMI+position strings.
+    Returns a NumPy array of uint64 keys, one per (UMI, Read2 position) pair.
     """
     if len(umi_list) != len(positions_r2_pf):
         logging.error(
             "Length of UMI list does not match length of Read2 positions after filtering."
         )
         sys.exit(1)
-    combined_umi = [f"{umi}{pos}" for umi, pos in zip(umi_list, positions_r2_pf)]
+    umi_codes, n_umis = encode_umis(umi_list)
+
+    # Read2 positions are shifted by one so that unmapped reads (-1) map to zero
+    n_positions = int(positions_r2_pf.max()) + 2 if len(positions_r2_pf) else 1
+    if n_umis * n_positions > 2**64:
+        logging.error("UMIs are too long to be combined with Read2 positions.")
+        sys.exit(1)
+    shifted_positions = (positions_r2_pf + 1).astype(np.uint64)
+    combined_umi = umi_codes * np.uint64(n_positions) + shifted_positions
     logging.info("Combined UMI with Read2 positions.")
     return combined_umi
 
 
+@njit(parallel=True, cache=True)
+def _count_distinct_sorted(sorted_index, sorted_umi, n_positions, n_chunks):
+    """
+    Counts the distinct UMIs at each position from reads sorted by position index
+    and then by UMI, splitting the reads into up to n_chunks chunks processed in
+    parallel.
+    Returns a NumPy array with the number of distinct UMIs per position index.
+    """
+    n_reads = len(sorted_index)
+    n_chunks = min(n_reads, n_chunks)
+    bounds = np.linspace(0, n_reads, n_chunks + 1).astype(np.int64)
+    counts_umi = np.zeros(n_positions, dtype=np.int64)
+    # The first position of a chunk may continue from the previous chunk, so its
+    # count is kept apart and added once all chunks are done
+    first_counts = np.zeros(n_chunks, dtype=np.int64)
+
+    for c in prange(n_chunks):
+        first_index = sorted_index[bounds[c]]
+        for i in range(bounds[c], bounds[c + 1]):
+            if (
+                i == 0
+                or sorted_index[i] != sorted_index[i - 1]
+                or sorted_umi[i] != sorted_umi[i - 1]
+            ):
+                if sorted_index[i] == first_index:
+                    first_counts[c] += 1
+                else:
+                    counts_umi[sorted_index[i]] += 1
+
+    for c in range(n_chunks):
+        counts_umi[sorted_index[bounds[c]]] += first_counts[c]
+    return counts_umi
+
+
 def discard_pcr_duplicates(positions_combined, combined_umi):
     """
     Discards PCR duplicates based on unique UMIs per position.
@@ -144,33 +277,35 @@ def discard_pcr_duplicates(positions_combined, combined_umi):
     # Ensure non-negative positions
     valid_indices = positions_combined != -1
     filtered_positions = positions_combined[valid_indices]
-    filtered_umi = [
-        umi for umi, pos in zip(combined_umi, positions_combined) if pos != -1
-    ]
-
-    # Unique positions and counts
-    unique, counts = np.unique(filtered_positions, return_counts=True)
-
-    # Initialize UMI-corrected counts
-    counts_umi = np.zeros(len(unique), dtype=int)
-
-    # Sort UMIs by positions to facilitate grouping
-    sorted_indices = np.argsort(filtered_positions)
-    sorted_positions = filtered_positions[sorted_indices]
-    sorted_umis = [filtered_umi[i] for i in sorted_indices]
-
-    # Group UMIs by position and count unique UMIs
-    unique_sorted, cumulative = np.unique(sorted_positions, return_counts=True)
-    cumulative = np.cumsum(cumulative)
-    start = 0
-    for i in range(len(unique_sorted)):
-        end = cumulative[i]
-        umi_set = set(sorted_umis[start:end])
-        counts_umi[i] = len(umi_set)
-        start = end
+    filtered_umi = combined_umi[valid_indices]
+
+    # Unique positions, raw counts, and the index of each read's position
+    unique_positions, position_index, counts = np.unique(
+        filtered_positions, return_inverse=True, return_counts=True
+    )
+
+    # Sort reads by position and then by UMI
+    order = np.lexsort((filtered_umi, position_index))
+    sorted_index = position_index[order]
+    sorted_umi = filtered_umi[order]
+
+    # Count unique UMIs at each position
+    if HAVE_NUMBA:
+        counts_umi = _count_distinct_sorted(
+            sorted_index, sorted_umi, len(unique_positions), 4 * get_num_threads()
+        )
+    else:
+        # Flag the first read of every distinct (position, UMI) combination
+        is_distinct = np.ones(len(order), dtype=bool)
+        is_distinct[1:] = (sorted_index[1:] != sorted_index[:-1]) | (
+            sorted_umi[1:] != sorted_umi[:-1]
+        )
+        counts_umi = np.bincount(
+            sorted_index[is_distinct], minlength=len(unique_positions)
+        )
 
     logging.info("Discarded PCR duplicates based on UMI data.")
-    return unique_sorted, counts, counts_umi
+    return unique_positions, counts, counts_umi
 
 
 def count_reads_per_ta_site(unique_positions, counts, counts_umi):
@@ -205,18 +340,17 @@ def save_position_counts(matrix, output_dir, sample_name):
 def extract_sample_name(sam_r1_path):
     """
     Extracts the sample name from the read 1 SAM filename.
-    Assumes the filename is in the format: {sample}_R1.sam
-    Adjust the regex pattern if your filenames follow a different convention.
+    Assumes the filename is in the format: {sample}_R1.sam, optionally with the
+    'filtered_' prefix added by filter_trim.py (e.g. filtered_{sample}_R1.sam).
     """
     sam_r1_filename = os.path.basename(sam_r1_path)
-    match = re.match(r".*/(?P<sample_name>.+)_R1_.*$", sam_r1_filename)
-    if match:
-        return match.group("sample")
-    else:
+    sample_name, separator, _ = sam_r1_filename.rpartition("_R1")
+    if not separator or not sample_name:
         logging.error(
             f"Read 1 SAM filename does not match expected pattern: {sam_r1_filename}"
         )
         sys.exit(1)
+    return sample_name.removeprefix("filtered_")
 
 
 def main():
@@ -233,31 +367,21 @@ def main():
     sample_name = extract_sample_name(args.sam_r1)
     logging.info(f"Processing sample: {sample_name}")
 
-    # Extract positions from SAM files
-    positions_r1 = get_positions(args.sam_r1)
-    positions_r2 = get_positions(args.sam_r2)
-
-    # Load UMI list
-    umi_list = load_umi_list(args.umi_list)
-
     # Load PF indices
     indices_pf = load_indices_pf(args.indices_pf)
 
-    # Slice out the data for Read2 corresponding to reads which passed the filter in Read1
-    positions_r2_pf = positions_r2[indices_pf]
-    umi_list_pf = [umi_list[x] for x in indices_pf]
+    # Extract positions from SAM files, keeping only the Read2 data corresponding to
+    # reads which passed the filter in Read1 (the Read1 SAM file only contains these)
+    positions_r1, positions_r2_pf = get_paired_positions(
+        args.sam_r1, args.sam_r2, indices_pf
+    )
 
-    # Assert that the length of the Read1 and Read2 PF positions array is equal
-    # Doing this check because we have already filtered out invalid reads without transposon
-    # for read 1 in the first step of the analysis
-    if len(positions_r1) != len(positions_r2_pf):
-        logging.error(
-            "Number of reads in read 1 and read 2 data is not equal after filtering."
-        )
-        sys.exit(1)
+    # Load UMI list
+    # (the UMI list only contains reads which passed the filter, so it is used as is)
+    umi_list = load_umi_list(args.umi_list)
 
-    # Create a list of UMIs where we incorporate the Read2 mapping coordinate
-    combined_umi = process_umi_positions(umi_list_pf, positions_r2_pf)
+    # Pair each UMI with the Read2 mapping coordinate
+    combined_umi = process_umi_positions(umi_list, positions_r2_pf)
 
     # Assert that the combined positions and the UMI list have the same length
     if len(positions_r1) != len(combined_umi):